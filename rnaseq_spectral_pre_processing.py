@@ -6,12 +6,23 @@ Purpose: RNA-Seq & Spectral preprocessing
 """
 
 import argparse
+import concurrent.futures
+import csv
+import io
 import os
 import sys
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
 import multiprocessing
-import warnings
-warnings.filterwarnings("ignore")
+from multiprocessing import shared_memory
+
+# Hyperspectral wavelength columns (nm) written alongside each transcript
+SPECTRA_COLS = [str(i) for i in range(350, 2501)]
+
+# Jobs writing fewer cells than this run in-process, as starting a pool would cost more than it saves
+POOL_MIN_CELLS = 5_000_000
 
 
 # --------------------------------------------------
@@ -58,63 +69,74 @@ def get_args():
                         nargs='+',
                         default=['WW', 'WL'])
 
-    return parser.parse_args()
+    parser.add_argument('-w',
+                        '--max_workers',
+                        help='Maximum number of worker processes.',
+                        metavar='int',
+                        type=int,
+                        default=multiprocessing.cpu_count())
+
+    args = parser.parse_args()
+
+    if args.max_workers < 1:
+        parser.error(f'--max_workers must be at least 1, got {args.max_workers}')
+
+    return args
 
 
 # --------------------------------------------------
-def get_rnaseq_data(csv_path, fb_path):
+def get_rnaseq_data(csv_path, fb):
     '''
-    Reads the RNA-Seq file and adds fieldbook data to it using the join function within Pandas.
+    Reads the RNA-Seq file and adds fieldbook data to it. TPM files are merged on entry and treatment,
+    which are parsed from the sample names; other files are joined on entry.
 
     Input:
         - csv_path: path to CSV file containing RNA-Seq data
-        - fb_path: path to CSV file containing fieldbook information
+        - fb: Dataframe containing fieldbook data, indexed by entry
     Output: 
         - rna_fb: Dataframe containing RNA-Seq and fieldbook information
     '''
 
-    fb = get_fieldbook_data(csv_path=fb_path, index='entry')
-    rna_df = pd.read_csv(csv_path)
-    rna_df['Gene'] = rna_df['Gene'].str.replace('Gohir.', 'Gh_')
-    rna_df = rna_df.set_index('Gene').T.reset_index().rename(columns={'index': 'entry'}).set_index('entry', drop=True)
+    rna_df = pd.read_csv(csv_path, engine='pyarrow')
+    genes = rna_df['Gene'].str.replace('Gohir.', 'Gh_', regex=False).to_numpy()
+    values = rna_df.drop(columns='Gene')
+    rna_df = pd.DataFrame(values.to_numpy().T,
+                          index=pd.Index(values.columns, name='entry'),
+                          columns=pd.Index(genes, name='Gene'))
     
     if 'TPM' in csv_path:
-        rna_df = rna_df.reset_index()
-        rna_df['treatment'] = ['_'.join(entry.split('_')[-1:]) for entry in rna_df['entry']]
-        rna_df['entry'] = ['_'.join(entry.split('_')[:-1]) for entry in rna_df['entry']]
-        rna_fb = fb.reset_index().set_index(['entry', 'treatment']).join(rna_df.set_index(['entry', 'treatment'])).reset_index().set_index('plot')
+        entry_parts = rna_df.index.str.rsplit('_', n=1)
+        rna_df = rna_df.reset_index(drop=True).assign(entry=entry_parts.str[0], treatment=entry_parts.str[-1])
+        rna_fb = fb.reset_index().merge(rna_df, on=['entry', 'treatment'], how='left').set_index('plot')
     
     else:
-        rna_fb = join_dataframes(df1=fb, df2=rna_df, convert_dtypes=True).set_index('plot')
+        rna_fb = join_dataframes(df1=fb, df2=rna_df).set_index('plot')
         
     return rna_fb
 
 
 # --------------------------------------------------
-def get_spectral_data(csv_path, fb_path):
+def get_spectral_data(csv_path):
     '''
-    Reads hyperspectral file and adds fieldbook data to it using the join function within Pandas.
+    Reads hyperspectral file and indexes it by plot number. Reflectance is stored as float32.
 
     Input: 
         - csv_path: path to CSV file containing hyperspectral data
-        - fb_path: path to CSV file containing fieldbook information
     Output: 
         - spectra_df: Dataframe containing only hyperspectral data
-        - spectra_fb: Dataframe containing both hyperspectral and fieldbook information
-        - fb: Dataframe containing only fieldbook data
     '''
 
-    fb = get_fieldbook_data(csv_path=fb_path, index='plot')
-    spectra_df = pd.read_csv(csv_path)
+    spectra_df = pd.read_csv(csv_path, engine='pyarrow')
 
     spectra_df = fix_plot_column(df=spectra_df)
 
-    spectra_df = spectra_df.set_index('Lambda').T.reset_index().rename(columns={'index': 'plot'}).set_index('plot', drop=True)
+    wavelengths = spectra_df['Lambda'].astype(str).to_numpy()
+    values = spectra_df.drop(columns='Lambda')
+    spectra_df = pd.DataFrame(values.to_numpy(dtype=np.float32).T,
+                              index=pd.Index(values.columns, name='plot'),
+                              columns=pd.Index(wavelengths, name='Lambda'))
 
-    spectra_df.columns = spectra_df.columns.astype(str)
-    spectra_fb = join_dataframes(df1=fb, df2=spectra_df, convert_dtypes=True)
-    
-    return spectra_df, spectra_fb, fb
+    return spectra_df
 
 
 # --------------------------------------------------
@@ -129,9 +151,8 @@ def get_fieldbook_data(csv_path, index):
         - fb: Dataframe containing fieldbook data
     '''
 
-    fb = pd.read_csv(csv_path).dropna(subset=['plot'])
-    fb['plot'] = pd.to_numeric(fb['plot']).astype(int).astype(str)
-    fb = fb.set_index(index)
+    fb = pd.read_csv(csv_path, engine='pyarrow').dropna(subset=['plot'])
+    fb = fb.assign(plot=fb['plot'].astype('int64').astype(str)).set_index(index)
     
 
     return fb
@@ -148,11 +169,11 @@ def fix_plot_column(df):
         - df: fixed dataframe with plot number
     '''
 
-    # plot_number_columns = [column.split('_')[1].replace('00000.asd', '').replace('p', '') for column in df.columns if 'Cotton' in column]
-    plot_number_columns = [column.split('_')[1].replace('00000.asd', '').replace('p', '') for column in df.columns if 'Cotton' in column or 'Sorghum' in column]
-    plot_number_columns.insert(0, 'Lambda')
+    columns = pd.Index(df.columns)
+    columns = columns[columns.str.contains('Cotton|Sorghum', regex=True)]
+    plot_number_columns = columns.str.split('_', n=2).str[1].str.replace('00000.asd', '', regex=False).str.replace('p', '', regex=False)
 
-    df.columns = plot_number_columns
+    df.columns = ['Lambda', *plot_number_columns]
     
     return df
 
@@ -181,9 +202,9 @@ def join_dataframes(df1, df2, convert_dtypes=False, groupby_list=None, stat=None
     if groupby_list:
         
         if stat=='mean':
-            joined_df = joined_df.groupby(by=groupby_list).mean()
+            joined_df = joined_df.groupby(by=groupby_list).mean(numeric_only=True)
         else:
-            joined_df = joined_df.groupby(by=groupby_list).median()
+            joined_df = joined_df.groupby(by=groupby_list).median(numeric_only=True)
     
     return joined_df
 
@@ -200,45 +221,115 @@ def get_transcript_list(df, substring):
         - transcript_list: list of all transcripts contained within the dataframe
     '''
 
-    transcript_list = [transcript for transcript in df.columns if substring in transcript]
+    transcript_list = df.columns[df.columns.str.contains(substring, regex=False, na=False)].tolist()
     
     return transcript_list 
 
 
 # --------------------------------------------------
-def generate_save_transcript_csv(transcript):
+def _share_array(arr):
+    '''
+    Copies an array into a new shared memory block.
+
+    Input:
+        - arr: NumPy array to share with the worker processes
+    Output:
+        - shm: SharedMemory block holding a copy of the array
+        - spec: tuple of (block name, shape, dtype) used to attach to the block
+    '''
+
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+
+    try:
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+# --------------------------------------------------
+def _attach_array(spec):
+    '''
+    Attaches to a shared memory block created by _share_array.
+
+    Input:
+        - spec: tuple of (block name, shape, dtype)
+    Output:
+        - shm: SharedMemory block, which must stay referenced while the array is in use
+        - arr: zero-copy NumPy view over the shared memory block
+    '''
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# --------------------------------------------------
+def _init_worker(index, column_index_map, quoting_style, spectra_spec, transcript_spec):
+    '''
+    Stores the values shared by every task within each worker process.
+
+    Input:
+        - index: row index (entry, treatment) of the joined RNA-Seq and hyperspectral data
+        - column_index_map: dictionary mapping transcript name to its column in the transcript matrix
+        - quoting_style: Arrow CSV quoting style for the rows, either "none" or "needed"
+        - spectra_spec: shared memory spec of the hyperspectral matrix
+        - transcript_spec: shared memory spec of the transcript matrix
+    Output:
+        - None, sets module globals used by generate_save_transcript_csv
+    '''
+
+    global row_index, transcript_columns, row_quoting
+    global spectra_matrix, transcript_matrix, shared_blocks
+    row_index = index
+    transcript_columns = column_index_map
+    row_quoting = quoting_style
+
+    spectra_shm, spectra_matrix = _attach_array(spectra_spec)
+    transcript_shm, transcript_matrix = _attach_array(transcript_spec)
+    shared_blocks = [spectra_shm, transcript_shm]
+
+
+# --------------------------------------------------
+def generate_save_transcript_csv(task):
     '''
     Generates RNA-Seq merged file for subsequent model training.
 
     Input: 
-        - transcript: a single transcript name to process
+        - task: tuple of (transcript name, output CSV path) for a single transcript to process
     Output: 
-        - CSV file saved to disk, within the specified output directory command line argument 
+        - CSV file saved to disk at the output CSV path given in task
     '''
 
-    args = get_args()
+    transcript, out_file = task
+
     # Collect response (RNAseq TPM) and explanatory variables (spectra) for a single transcript
-    temp_data = rnaseq_spectra.dropna(subset=[transcript])
-    temp_data = temp_data.dropna(subset=['350', '2500'])
-    
-    
-    column_list = [str(i) for i in range(350, 2501)]
-    column_list.insert(0, transcript)
-    result = temp_data[column_list]
-    
-    if not os.path.isdir(args.out_dir):
-        try:
-            os.makedirs(args.out_dir)
-        except OSError:
-            pass
+    response = transcript_matrix[:, transcript_columns[transcript]]
+    row_mask = ~np.isnan(response)
 
-    if 'TPM' in args.rnaseq_csv:
-        out_file = os.path.join(args.out_dir, '_'.join([transcript, 'tpm_spectra.csv']))
+    spectra = np.ascontiguousarray(spectra_matrix[row_mask].T)
 
-    else:
-        out_file = os.path.join(args.out_dir, '_'.join([transcript, 'logfc_spectra.csv']))
+    # Build Arrow columns over the selected rows; NaN is written as an empty field, as with to_csv.
+    # Numbers use Arrow's shortest formatting, e.g. 0 rather than 0.0 and 1e-7 rather than 1e-07
+    columns = [pa.array(row_index.get_level_values(level)[row_mask].to_numpy()) for level in range(row_index.nlevels)]
+    columns.append(pa.array(response[row_mask], from_pandas=True))
+    columns.extend(pa.array(values, from_pandas=True) for values in spectra)
+    column_names = [*row_index.names, transcript, *SPECTRA_COLS]
+    result = pa.Table.from_arrays(columns, names=column_names)
 
-    result.to_csv(out_file)
+    # Header is written with the csv module, which quotes names only when needed as to_csv did,
+    # since the Arrow writer always quotes column names
+    header = io.StringIO()
+    csv.writer(header, lineterminator='\n').writerow(column_names)
+
+    with open(out_file, 'wb') as f:
+        f.write(header.getvalue().encode())
+        pa.csv.write_csv(result, f, write_options=pa.csv.WriteOptions(include_header=False, quoting_style=row_quoting))
 
 
 # --------------------------------------------------
@@ -248,18 +339,19 @@ def main():
     """
 
     args = get_args()
-    # Get RNA-seq data
-    rna_fb = get_rnaseq_data(csv_path=args.rnaseq_csv,
-                            fb_path=args.fieldbook_csv)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # Get spectral data, downloading it while the fieldbook and RNA-seq files are read
+        spectra_future = executor.submit(get_spectral_data, csv_path=args.spectral_csv)
+
+        # Get RNA-seq data
+        fb = get_fieldbook_data(csv_path=args.fieldbook_csv, index='entry')
+        rna_fb = get_rnaseq_data(csv_path=args.rnaseq_csv, fb=fb)
+
+        spectra_df = spectra_future.result()
     
     rna_fb = rna_fb[rna_fb['treatment'].isin(args.treatment)]
 
-    # Get spectral data
-    spectra_df, spectra_fb, fb = get_spectral_data(csv_path=args.spectral_csv,
-                                fb_path=args.fieldbook_csv)
-
     # Join RNA-seq and spectral data into single dataframe
-    global rnaseq_spectra
     rnaseq_spectra = join_dataframes(df1=rna_fb, df2=spectra_df, groupby_list=['entry', 'treatment'], stat='mean')
 
 
@@ -269,8 +361,70 @@ def main():
     if not transcript_list:
         transcript_list = get_transcript_list(df=rnaseq_spectra, substring='Sobic.')
 
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-        p.map(generate_save_transcript_csv, transcript_list)
+    os.makedirs(args.out_dir, exist_ok=True)
+    suffix = 'tpm' if 'TPM' in args.rnaseq_csv else 'logfc'
+
+    # Rows missing spectra are dropped once here, as the mask is the same for every transcript
+    spectra_valid = rnaseq_spectra[['350', '2500']].notna().all(axis=1).to_numpy()
+    row_index = rnaseq_spectra.index[spectra_valid]
+
+    spectra_loc = rnaseq_spectra.columns.get_indexer(SPECTRA_COLS)
+    transcript_loc = rnaseq_spectra.columns.get_indexer(transcript_list)
+
+    # get_indexer marks missing labels with -1, which iloc would silently read as the last column
+    for names, loc in ((SPECTRA_COLS, spectra_loc), (transcript_list, transcript_loc)):
+        if (loc == -1).any():
+            missing = [name for name, i in zip(names, loc) if i == -1]
+            raise KeyError(f'Columns not found in the joined RNA-Seq and hyperspectral data: {missing}')
+
+    # Arrow quotes every string value once quoting is on, so only enable it when an entry or treatment needs it
+    needs_quoting = any(row_index.get_level_values(level).astype(str).str.contains('[,"\r\n]', regex=True).any()
+                        for level in range(row_index.nlevels))
+    quoting_style = 'needed' if needs_quoting else 'none'
+
+    # Share the hyperspectral and transcript values with the workers as plain NumPy buffers
+    spectra_values = rnaseq_spectra.iloc[spectra_valid, spectra_loc].to_numpy(dtype=np.float32, na_value=np.nan)
+    transcript_values = rnaseq_spectra.iloc[spectra_valid, transcript_loc].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    column_index_map = {transcript: i for i, transcript in enumerate(transcript_list)}
+    tasks = [(transcript, os.path.join(args.out_dir, '_'.join([transcript, suffix, 'spectra.csv'])))
+             for transcript in transcript_list]
+    n_cells = len(transcript_list) * spectra_values.size
+
+    # Blocks are tracked as they are created so a failure part way through setup still unlinks them
+    shm_blocks = []
+
+    try:
+        shm_specs = []
+        for values in (spectra_values, transcript_values):
+            shm, spec = _share_array(values)
+            shm_blocks.append(shm)
+            shm_specs.append(spec)
+
+        worker_args = (row_index, column_index_map, quoting_style, *shm_specs)
+
+        # Release the dataframes and local copies so forked workers only map the shared blocks
+        del fb, rna_fb, spectra_future, spectra_df, rnaseq_spectra, spectra_values, transcript_values
+
+        if args.max_workers == 1 or n_cells < POOL_MIN_CELLS:
+            _init_worker(*worker_args)
+            for task in tasks:
+                generate_save_transcript_csv(task)
+
+        else:
+            # Send transcripts in chunks so dispatch overhead is amortized over several short tasks
+            chunksize = max(1, len(transcript_list) // (args.max_workers * 4))
+
+            with multiprocessing.Pool(args.max_workers,
+                                      initializer=_init_worker,
+                                      initargs=worker_args) as p:
+                for _ in p.imap_unordered(generate_save_transcript_csv, tasks, chunksize=chunksize):
+                    pass
+
+    finally:
+        for shm in shm_blocks:
+            shm.close()
+            shm.unlink()
         
     print('Processing complete.')
 